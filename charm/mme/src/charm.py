@@ -112,9 +112,11 @@ class MmeCharm(CharmBase):
         apps_api = kubernetes.client.AppsV1Api(kubernetes.client.ApiClient())
         # Get the StatefulSet for the deployed application
         s = apps_api.read_namespaced_stateful_set(name=self.app.name, namespace=self.namespace)
-        # Create a volume mount that we expect to be present after patching the StatefulSet
-        expected = kubernetes.client.V1VolumeMount(mount_path="/opt/mme/config/shared", name="shared-data")
-        return expected in s.spec.template.spec.containers[1].volume_mounts
+        # Check for a volume mount that we expect to be present after patching the StatefulSet
+        mounts = {
+            (m.mount_path, m.name) for m in s.spec.template.spec.containers[1].volume_mounts or []
+        }
+        return ("/opt/mme/config/shared", "shared-data") in mounts
 
     def _patch_stateful_set(self) -> None:
         """Patch the StatefulSet to include specific ServiceAccount and Secret mounts"""
@@ -4,25 +4,66 @@
 #
 # Learn more at: https://juju.is/docs/sdk
 
-from files import *
+import asyncio
+from functools import cached_property
 import logging
 import os
+import time
 from typing import Optional
 from subprocess import check_output
 from ipaddress import IPv4Address
-import datetime
-from cryptography import x509
-import glob
 from ops.charm import CharmBase, InstallEvent, RemoveEvent
 from ops.framework import StoredState
 from ops.main import main
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus
-from kubernetes import kubernetes
+import kubernetes_asyncio as kubernetes
 from pathlib import Path
 import resources
 
 logger = logging.getLogger(__name__)
 
+# How long a successful auth probe is trusted for, in seconds
+CACHE_TTL = 300
+# Shared across hook invocations, each of which runs in a fresh charm process
+AUTH_FILE = Path("/run/charm-authed")
+# Holds the environment of the charm container, which Juju does not pass on to hooks
+PID1_ENVIRON = Path("/proc/1/environ")
+# Initial Pebble layer configuration; it has no per-unit values, so it is built once
+PEBBLE_LAYER = {
+    "summary": "spgwc layer",
+    "description": "pebble config layer for httpbin",
+    "services": {
+        "spgwc": {
+            "override": "replace",
+            "summary": "spgwc",
+            "command": """/bin/bash -xc "/opt/cp/scripts/spgwc-run.sh" """,
+            "startup": "enabled",
+        }
+    },
+}
+
+
+def _read_pid1_environ(*prefixes: bytes) -> dict:
+    """Return the variables in PID 1's environment whose names start with one of prefixes"""
+    env = {}
+    for e in PID1_ENVIRON.read_bytes().split(b"\x00"):
+        if e.startswith(prefixes):
+            name, _, value = e.partition(b"=")
+            env[name.decode()] = value.decode()
+    return env
+
+
+def _run_hook(coro) -> None:
+    """Run an async hook handler, closing the shared API client before its event loop ends"""
+
+    async def run():
+        try:
+            await coro
+        finally:
+            await resources.close_api_client()
+
+    asyncio.run(run())
+
 
 class SpgwcCharm(CharmBase):
     """Charm the service."""
@@ -37,31 +78,19 @@ class SpgwcCharm(CharmBase):
         self.framework.observe(self.on.fortune_action, self._on_fortune_action)
         self.framework.observe(self.on.install, self._on_install)
         self.framework.observe(self.on.remove, self._on_remove)
-        self._stored.set_default(things=[])
 
     def _on_spgwc_pebble_ready(self, event):
         # Get a reference the container attribute on the PebbleReadyEvent
         container = event.workload
-        # Define an initial Pebble layer configuration
-        pebble_layer = {
-            "summary": "spgwc layer",
-            "description": "pebble config layer for httpbin",
-            "services": {
-                "spgwc": {
-                    "override": "replace",
-                    "summary": "spgwc",
-                    "command": """/bin/bash -xc "/opt/cp/scripts/spgwc-run.sh" """,
-                    "startup": "enabled",
-                }
-            },
-        }
         scriptPath = "/opt/cp/scripts/"
         configPath = "/etc/cp/config/"
-        self._push_file_to_container(container, "src/files/script/*.*", scriptPath, 0o755)
+        self._push_file_to_container(
+            container, "src/files/script/*.*", scriptPath, 0o755, renderNamespace=True
+        )
         self._push_file_to_container(container, "src/files/config/*.*", configPath, 0o755)
 
         # Add intial Pebble config layer using the Pebble API
-        container.add_layer("spgwc", pebble_layer, combine=True)
+        container.add_layer("spgwc", PEBBLE_LAYER, combine=True)
         if not container.get_service("spgwc").is_running():
             container.start("spgwc")
             logger.info("spgwc service started")
@@ -70,66 +99,84 @@ class SpgwcCharm(CharmBase):
         self.unit.status = ActiveStatus()
 
     def _on_config_changed(self, event) -> None:
+        _run_hook(self._config_changed(event))
+
+    async def _config_changed(self, event) -> None:
         # Defer the config-changed event if we do not have sufficient privileges
-        if not self._k8s_auth():
+        if not await self._k8s_auth():
             event.defer()
             return
 
-        # Default StatefulSet needs patching for inicontainers and extra volumes. Ensure that
-        # the StatefulSet is patched on each invocation.
-        if not self._statefulset_patched:
-            self._patch_stateful_set()
-            self.unit.status = MaintenanceStatus("waiting for changes to apply")
+        # Default StatefulSet needs patching for inicontainers and extra volumes. The patch is
+        # a server-side apply, which is idempotent, so it is applied on each invocation.
+        try:
+            await self._patch_stateful_set()
+        except kubernetes.client.exceptions.ApiException as e:
+            await self._handle_auth_error(event, e)
+            return
         self.unit.status = ActiveStatus()
 
-    @property
-    def _statefulset_patched(self) -> bool:
-        """Slightly naive check to see if the StatefulSet has already been patched"""
-        # Get an API client
-        apps_api = kubernetes.client.AppsV1Api(kubernetes.client.ApiClient())
-        # Get the StatefulSet for the deployed application
-        s = apps_api.read_namespaced_stateful_set(name=self.app.name, namespace=self.namespace)
-        # Create a volume mount that we expect to be present after patching the StatefulSet
-        expected = kubernetes.client.V1EnvVar(
-                name = "MME_ADDR",
-                value_from = kubernetes.client.V1EnvVarSource(
-                    config_map_key_ref = kubernetes.client.V1ConfigMapKeySelector(
-                        key = "IP",
-                        name = "mme-ip",
-                    ),
-                ),
-            )
-        return expected in s.spec.template.spec.containers[1].env
-
-    def _patch_stateful_set(self) -> None:
+    async def _patch_stateful_set(self) -> None:
         """Patch the StatefulSet to include specific ServiceAccount and Secret mounts"""
         self.unit.status = MaintenanceStatus("patching StatefulSet for additional k8s permissions")
-        # Get an API client
-        api = kubernetes.client.AppsV1Api(kubernetes.client.ApiClient())
         r = resources.SpgwcResources(self)
-        # Read the StatefulSet we're deployed into
-        s = api.read_namespaced_stateful_set(name=self.app.name, namespace=self.namespace)
-        # Add ServiceName to the statefulset spec
-        #s.spec.service_name = "spgwc-headless"
-        # Add the required volume mounts to the mme container spec
-        s.spec.template.spec.containers[1].env.extend(r.spgwc_add_env)
-        # Add additional init containers required for mme
-        s.spec.template.spec.init_containers.extend(r.add_spgwc_init_containers)
-        # Add resource limit to each container
-        s.spec.template.spec.containers[1].resources = kubernetes.client.V1ResourceRequirements(
-                limits = {
-                    "cpu": "2",
-                    "memory": "2Gi"
+        # Only the fields we own are sent; the API server merges them into the StatefulSet
+        # created by Juju, so there is no need to read it back first
+        patch = {
+            "apiVersion": "apps/v1",
+            "kind": "StatefulSet",
+            "metadata": {"name": self.app.name, "namespace": self.namespace},
+            "spec": {
+                "template": {
+                    "spec": {
+                        # Add additional init containers required for mme
+                        "initContainers": r.add_spgwc_init_containers,
+                        "containers": [
+                            kubernetes.client.V1Container(
+                                name = "spgwc",
+                                # Add the required env to the spgwc container spec
+                                env = r.spgwc_add_env,
+                                # Add resource limit to the container
+                                resources = kubernetes.client.V1ResourceRequirements(
+                                    limits = {
+                                        "cpu": "2",
+                                        "memory": "2Gi"
+                                    },
+                                    requests = {
+                                        "cpu": "2",
+                                        "memory": "2Gi"
+                                    }
+                                ),
+                                stdin = True,
+                                tty = True,
+                            ),
+                            # Expose the pod IP to the charm itself, see pod_ip
+                            kubernetes.client.V1Container(
+                                name = "charm",
+                                env = [
+                                    kubernetes.client.V1EnvVar(
+                                        name = "POD_IP",
+                                        value_from = kubernetes.client.V1EnvVarSource(
+                                            field_ref = kubernetes.client.V1ObjectFieldSelector(
+                                                field_path="status.podIP"
+                                            ),
+                                        ),
+                                    ),
+                                ],
+                            ),
+                        ],
+                    },
                 },
-                requests = {
-                    "cpu": "2",
-                    "memory": "2Gi"
-                }
-            )
-        s.spec.template.spec.containers[1].stdin = True
-        s.spec.template.spec.containers[1].tty = True
-        # Patch the StatefulSet with our modified object
-        api.patch_namespaced_stateful_set(name=self.app.name, namespace=self.namespace, body=s)
+            },
+        }
+        await r.apps_api.patch_namespaced_stateful_set(
+            name=self.app.name,
+            namespace=self.namespace,
+            body=patch,
+            field_manager="spgwc-charm",
+            force=True,
+            _content_type="application/apply-patch+yaml",
+        )
         logger.info("Patched StatefulSet to include additional volumes and mounts")
 
     def _on_fortune_action(self, event):
@@ -149,34 +196,44 @@ class SpgwcCharm(CharmBase):
             event.set_results({"fortune": "A bug in the code is worth two in the documentation."})
 
 
-    def _push_file_to_container(self, container, srcPath, dstPath, filePermission):
-        for filePath in glob.glob(srcPath):
+    def _push_file_to_container(
+        self, container, srcPath, dstPath, filePermission, renderNamespace=False
+    ):
+        for filePath in resources.iter_files(*os.path.split(srcPath)):
             print("Loading file name:" + filePath)
-            fileData = resources.SpgwcResources(self).loadfile(filePath)
             fileName = os.path.basename(filePath)
-            container.push(dstPath + fileName, fileData, make_dirs=True, permissions=filePermission)
+            with open(filePath, "rb") as f:
+                # Stream the file to Pebble unless the namespace needs substituting, which is
+                # done in memory rather than by rewriting the charm's copy
+                source = (
+                    f.read().replace(b"NAMESPACE", self.namespace.encode())
+                    if renderNamespace
+                    else f
+                )
+                container.push(
+                    dstPath + fileName, source, make_dirs=True, permissions=filePermission
+                )
    
    
-    def _k8s_auth(self) -> bool:
+    async def _k8s_auth(self) -> bool:
         """Authenticate to kubernetes."""
         if self._authed:
             return True
         # Remove os.environ.update when lp:1892255 is FIX_RELEASED.
-        os.environ.update(
-            dict(
-                e.split("=")
-                for e in Path("/proc/1/environ").read_text().split("\x00")
-                if "KUBERNETES_SERVICE" in e
-            )
-        )
+        os.environ.update(self._pid1_environ)
         # Authenticate against the Kubernetes API using a mounted ServiceAccount token
         kubernetes.config.load_incluster_config()
+        # Skip the permissions probe if an earlier hook passed it recently
+        if self._auth_cached():
+            self._authed = True
+            return True
         # Test the service account we've got for sufficient perms
-        auth_api = kubernetes.client.RbacAuthorizationV1Api(kubernetes.client.ApiClient())
-
+        auth_api = kubernetes.client.RbacAuthorizationV1Api(resources.get_api_client())
         try:
-            auth_api.list_cluster_role()
+            await auth_api.list_cluster_role()
         except kubernetes.client.exceptions.ApiException as e:
+            if e.status in (401, 403):
+                await self._invalidate_auth()
             if e.status == 403:
                 # If we can't read a cluster role, we don't have enough permissions
                 self.unit.status = BlockedStatus("Run juju trust on this application to continue")
@@ -185,37 +242,93 @@ class SpgwcCharm(CharmBase):
                 raise e
 
         self._authed = True
+        try:
+            AUTH_FILE.write_text(str(time.time()))
+        except OSError as e:
+            logger.debug("Unable to persist auth state: %s", e)
         return True
-    @property
+
+    def _auth_cached(self) -> bool:
+        """Check whether a previous hook passed the permissions probe within the TTL."""
+        try:
+            authed_at = float(AUTH_FILE.read_text())
+        except (OSError, ValueError):
+            return False
+        return time.time() - authed_at < CACHE_TTL
+
+    async def _handle_auth_error(self, event, e) -> None:
+        """Defer the event if the API rejected our credentials, otherwise re-raise the error."""
+        if e.status not in (401, 403):
+            raise e
+        await self._invalidate_auth()
+        # The cached auth may have outlived the trust; probe again so that revoked trust
+        # sets BlockedStatus rather than failing the hook
+        if await self._k8s_auth():
+            raise e
+        event.defer()
+
+    async def _invalidate_auth(self) -> None:
+        """Forget cached auth state after the API rejected our credentials."""
+        self._authed = False
+        # Drop the shared client so the next call reconnects with freshly loaded credentials
+        await resources.close_api_client()
+        try:
+            AUTH_FILE.unlink()
+        except FileNotFoundError:
+            pass
+
+    @cached_property
     def namespace(self) -> str:
-        with open("/var/run/secrets/kubernetes.io/serviceaccount/namespace", "r") as f:
-            return f.read().strip()
+        # The namespace cannot change for the lifetime of the pod
+        return Path("/var/run/secrets/kubernetes.io/serviceaccount/namespace").read_text().strip()
+
+    @cached_property
+    def _pid1_environ(self) -> dict:
+        # The charm container's environment, which hooks do not inherit (lp:1892255). It is
+        # read once for both the API server address and the pod IP.
+        return _read_pid1_environ(b"KUBERNETES_SERVICE", b"POD_IP")
 
-    @property
+    @cached_property
     def pod_ip(self) -> Optional[IPv4Address]:
+        # Set through the Downward API once the StatefulSet is patched, which saves running
+        # the unit-get hook tool
+        pod_ip = self._pid1_environ.get("POD_IP")
+        if pod_ip:
+            return IPv4Address(pod_ip)
         return IPv4Address(check_output(["unit-get", "private-address"]).decode().strip())
 
     def _on_install(self, event: InstallEvent) -> None:
         """Event handler for InstallEvent during which we will update the K8s service."""
-        
+        _run_hook(self._install(event))
+
+    async def _install(self, event: InstallEvent) -> None:
         """Handle the install event, create Kubernetes resources"""
-        if not self._k8s_auth():
+        if not await self._k8s_auth():
             event.defer()
             return
         self.unit.status = MaintenanceStatus("creating k8s resources")
         # Create the Kubernetes resources needed for the spgwc
         r = resources.SpgwcResources(self)
-        r.apply()
+        try:
+            await r.apply()
+        except kubernetes.client.exceptions.ApiException as e:
+            await self._handle_auth_error(event, e)
 
     def _on_remove(self, event: RemoveEvent) -> None:
+        _run_hook(self._remove(event))
+
+    async def _remove(self, event: RemoveEvent) -> None:
         """Cleanup Kubernetes resources"""
         # Authenticate with the Kubernetes API
-        if not self._k8s_auth():
+        if not await self._k8s_auth():
             event.defer()
             return
         # Remove created Kubernetes resources
         r = resources.SpgwcResources(self)
-        r.delete()
+        try:
+            await r.delete()
+        except kubernetes.client.exceptions.ApiException as e:
+            await self._handle_auth_error(event, e)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,69 @@
 # Copyright 2021 Canonical
 # See LICENSE file for licensing details.
+import asyncio
+import fnmatch
+from functools import cached_property
 import logging
-import glob
 import os
+from pathlib import Path
 
-from kubernetes import kubernetes
+import kubernetes_asyncio as kubernetes
+import orjson
 
 logger = logging.getLogger(__name__)
 
+# Have the client (de)serialize request and response bodies with orjson rather than the
+# stdlib json module; it only ever calls json.dumps(body) and json.loads(data)
+kubernetes.client.rest.json = orjson
+kubernetes.client.api_client.json = orjson
+
+# Upper bound on concurrent Kubernetes API calls made by apply() and delete()
+MAX_CONCURRENT_REQUESTS = 8
+
+
+# ApiClient shared by every Kubernetes call made while handling a hook
+_api_client = None
+
+
+def get_api_client():
+    """Return the shared ApiClient, creating it on first use.
+
+    Sharing one client lets calls reuse its connection pool instead of paying for a new TLS
+    handshake each time. It must be created after the in-cluster config has been loaded,
+    from inside the event loop that will use it.
+    """
+    global _api_client
+    if _api_client is None:
+        _api_client = kubernetes.client.ApiClient()
+    return _api_client
+
+
+async def close_api_client():
+    """Close the shared ApiClient, so a later call to get_api_client() starts afresh"""
+    global _api_client
+    if _api_client is not None:
+        client, _api_client = _api_client, None
+        await client.close()
+
+
+def iter_files(directory, pattern="*"):
+    """Return the paths of the files in directory whose names match pattern.
+
+    Equivalent to glob.glob(os.path.join(directory, pattern)) for a single directory
+    level, including returning nothing for a missing directory, but reads the directory
+    once with os.scandir and reuses its cached file types.
+    """
+    try:
+        it = os.scandir(directory)
+    except FileNotFoundError:
+        return []
+    with it:
+        return [
+            e.path
+            for e in it
+            if not e.name.startswith(".") and e.is_file() and fnmatch.fnmatchcase(e.name, pattern)
+        ]
+
 
 class SpgwuResources:
     """Class to handle the creation and deletion of those Kubernetes resources
@@ -18,72 +74,100 @@ class SpgwuResources:
         self.app = charm.app
         self.config = charm.config
         self.namespace = charm.namespace
-        # Setup some Kubernetes API clients we'll need
-        kcl = kubernetes.client.ApiClient()
-        self.apps_api = kubernetes.client.AppsV1Api(kcl)
-        self.core_api = kubernetes.client.CoreV1Api(kcl)
-        self.auth_api = kubernetes.client.RbacAuthorizationV1Api(kcl)
 
         self.script_path = "src/files/Script/*.*"
         #self.config_path = "src/files/config/*.*"
         self.runscriptPath = "src/files/*.*"
         self.configPath = "src/files/Config/*.*"
 
-    def apply(self) -> None:
+    # Kubernetes API clients are only built when first used, from inside the event loop
+    @cached_property
+    def apps_api(self):
+        return kubernetes.client.AppsV1Api(get_api_client())
+
+    @cached_property
+    def core_api(self):
+        return kubernetes.client.CoreV1Api(get_api_client())
+
+    @cached_property
+    def auth_api(self):
+        return kubernetes.client.RbacAuthorizationV1Api(get_api_client())
+
+    async def apply(self) -> None:
         """Create the required Kubernetes resources for the dashboard"""
+        # Services and ConfigMaps do not depend on each other, create them concurrently
+        tasks = [self._apply_service(service) for service in self._services] + [
+            self._apply_configmap(cm) for cm in self._configmaps
+        ]
+        await self._gather(tasks)
 
-        # Create Kubernetes Services
-        for service in self._services:
-            s = self.core_api.list_namespaced_service(
-                namespace=service["namespace"],
-                field_selector=f"metadata.name={service['body'].metadata.name}",
+    async def _apply_service(self, service) -> None:
+        """Create the service, or patch it if it already exists"""
+        try:
+            await self.core_api.create_namespaced_service(**service)
+        except kubernetes.client.exceptions.ApiException as e:
+            # 409 Conflict: the service already exists
+            if e.status != 409:
+                raise e
+            logger.info(
+                "service '%s' in namespace '%s' exists, patching",
+                service["body"].metadata.name,
+                service["namespace"],
+            )
+            await self.core_api.patch_namespaced_service(
+                name=service["body"].metadata.name, **service
             )
-            if not s.items:
-                self.core_api.create_namespaced_service(**service)
-            else:
-                logger.info(
-                    "service '%s' in namespace '%s' exists, patching",
-                    service["body"].metadata.name,
-                    service["namespace"],
-                )
-                self.core_api.patch_namespaced_service(
-                    name=service["body"].metadata.name, **service
-                )
-
-        for cm in self._configmaps:
-            s = self.core_api.list_namespaced_config_map(
-                namespace=cm["namespace"],
-                field_selector=f"metadata.name={cm['body'].metadata.name}",
+
+    async def _apply_configmap(self, cm) -> None:
+        """Create the configmap, or patch it if it already exists"""
+        try:
+            await self.core_api.create_namespaced_config_map(**cm)
+        except kubernetes.client.exceptions.ApiException as e:
+            # 409 Conflict: the configmap already exists
+            if e.status != 409:
+                raise e
+            logger.info(
+                "configmap '%s' in namespace '%s' exists, patching",
+                cm["body"].metadata.name,
+                cm["namespace"],
             )
-            if not s.items:
-                self.core_api.create_namespaced_config_map(**cm)
-            else:
-                logger.info(
-                    "configmap '%s' in namespace '%s' exists, patching",
-                    cm["body"].metadata.name,
-                    cm["namespace"],
-                )
-                self.core_api.patch_namespaced_config_map(name=cm["body"].metadata.name, **cm)
+            await self.core_api.patch_namespaced_config_map(name=cm["body"].metadata.name, **cm)
+
+    async def _gather(self, tasks) -> None:
+        """Run the API calls concurrently, raising the first failure once all have finished"""
+        # Bound the number of requests in flight so we don't overload the API server
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
+        async def bounded(task):
+            async with semaphore:
+                return await task
 
+        results = await asyncio.gather(*[bounded(t) for t in tasks], return_exceptions=True)
+        errors = [r for r in results if isinstance(r, Exception)]
+        for e in errors:
+            logger.error("Kubernetes API call failed: %s", e)
+        if errors:
+            raise errors[0]
 
-    def delete(self) -> None:
+    async def delete(self) -> None:
         """Delete all of the Kubernetes resources created by the apply method"""
-        #Delete Kubernetes services
-        for service in self._services:
+        # Delete Kubernetes services and configmaps concurrently
+        tasks = [
             self.core_api.delete_namespaced_service(
                 namespace=service["namespace"], name=service["body"].metadata.name
             )
+            for service in self._services
+        ] + [
+            self.core_api.delete_namespaced_config_map(
+                namespace=cm["namespace"], name=cm["body"].metadata.name
+            )
+            for cm in self._configmaps
+        ]
+        await self._gather(tasks)
 
         logger.info("Deleted additional Kubernetes resources")
 
-        #Delete Kubernetes configmaps
-        for cm in self._configmaps:
-           self.core_api.delete_namespaced_config_map(
-               namespace=cm["namespace"], name=cm["body"].metadata.name
-           )
-
-    @property
+    @cached_property
     def add_spgwu_init_containers(self) -> dict:
         """Returns the addtional init_containers required for mme"""
         return [
@@ -105,7 +189,7 @@ class SpgwuResources:
             ),
         ]
 
-    @property
+    @cached_property
     def spgwu_add_env(self) -> dict:
         """Returns the additional env for the spgwc containers"""
         return [
@@ -121,25 +205,23 @@ class SpgwuResources:
             ),
         ]
 
-    @property
-    def add_container_resource_limit(self, containers):
-        #Length of list containers
-        length = len(containers)
-        itr = 1
-
-        while itr < length:
-            containers[itr].resources = kubernetes.client.V1ResourceRequirements(
-                limits = {
-                    'cpu': '0.2',
-                    'memory': '200Mi'
-                },
-                requests = {
-                    'cpu': '0.2',
-                    'memory': '200Mi'
-                }
-            )
+    def set_container_resource_limits(self, containers, skip_first=True) -> None:
+        """Apply the default resource limits to containers, skipping the first by default"""
+        # V1ResourceRequirements is never mutated, so one object is shared by every container
+        limits = kubernetes.client.V1ResourceRequirements(
+            limits = {
+                'cpu': '0.2',
+                'memory': '200Mi'
+            },
+            requests = {
+                'cpu': '0.2',
+                'memory': '200Mi'
+            }
+        )
+        for container in containers[1 if skip_first else 0:]:
+            container.resources = limits
 
-    @property
+    @cached_property
     def _services(self) -> list:
         """Return a list of Kubernetes services needed by the mme"""
         # Note that this service is actually created by Juju, we are patching
@@ -172,24 +254,12 @@ class SpgwuResources:
             },
         ]
 
-    def loadfile(self, file_name):
-        '''Read the file content and return content data'''
-        with open(file_name, 'r') as f:
-            data = f.read()
-            f.close()
-            return data
-
-
     def _get_config_data(self, files_path):
         """Return the dictionary of file contnent and name needed by mme"""
-        dicts = {}
-        for file_path in glob.glob(files_path):
-            file_data = self.loadfile(file_path)
-            file_name = os.path.basename(file_path)
-            dicts[file_name] = file_data
-        return dicts
+        files = iter_files(*os.path.split(files_path))
+        return {os.path.basename(p): Path(p).read_text() for p in files}
 
-    @property
+    @cached_property
     def _configmaps(self) -> list:
         """Return a list of ConfigMaps needed by the mme"""
         dict_script = self._get_config_data(self.script_path)
@@ -3,11 +3,19 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import asyncio
+import json
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock
+from pathlib import Path
+from unittest.mock import AsyncMock, Mock, patch
 
+import charm
+import kubernetes_asyncio as kubernetes
+import resources
 from charm import SpgwuCharm
-from ops.model import ActiveStatus
+from ops.model import ActiveStatus, BlockedStatus
 from ops.testing import Harness
 
 
@@ -17,10 +25,24 @@ class TestCharm(unittest.TestCase):
         self.addCleanup(self.harness.cleanup)
         self.harness.begin()
 
+    def patch(self, *args, **kwargs):
+        patcher = patch.object(*args, **kwargs)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
     def test_config_changed(self):
-        self.assertEqual(list(self.harness.charm._stored.things), [])
+        self.patch(SpgwuCharm, "_k8s_auth", return_value=True)
+        patch_stateful_set = self.patch(SpgwuCharm, "_patch_stateful_set")
+        self.harness.update_config({"thing": "foo"})
+        patch_stateful_set.assert_awaited_once_with()
+        self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_config_changed_without_trust(self):
+        self.patch(SpgwuCharm, "_k8s_auth", return_value=False)
+        patch_stateful_set = self.patch(SpgwuCharm, "_patch_stateful_set")
         self.harness.update_config({"thing": "foo"})
-        self.assertEqual(list(self.harness.charm._stored.things), ["foo"])
+        patch_stateful_set.assert_not_called()
+        self.assertNotEqual(self.harness.model.unit.status, ActiveStatus())
 
     def test_action(self):
         # the harness doesn't (yet!) help much with actions themselves
@@ -64,3 +86,322 @@ class TestCharm(unittest.TestCase):
         self.assertTrue(service.is_running())
         # Ensure we set an ActiveStatus with no message
         self.assertEqual(self.harness.model.unit.status, ActiveStatus())
+
+    def test_pod_ip_from_downward_api(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.patch(charm, "PID1_ENVIRON", Path(tmp.name, "environ"))
+        charm.PID1_ENVIRON.write_bytes(b"HOME=/root\x00POD_IP=10.1.2.3\x00")
+        check_output = self.patch(charm, "check_output")
+
+        self.assertEqual(str(self.harness.charm.pod_ip), "10.1.2.3")
+        check_output.assert_not_called()
+
+    def test_pod_ip_falls_back_to_unit_get(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.patch(charm, "PID1_ENVIRON", Path(tmp.name, "environ"))
+        charm.PID1_ENVIRON.write_bytes(b"HOME=/root\x00")
+        check_output = self.patch(charm, "check_output", return_value=b"10.4.5.6\n")
+
+        self.assertEqual(str(self.harness.charm.pod_ip), "10.4.5.6")
+        check_output.assert_called_once_with(["unit-get", "private-address"])
+
+    def test_patch_stateful_set(self):
+        self.patch(SpgwuCharm, "namespace", "ns")
+        apply = self.patch(
+            charm.kubernetes.client.AppsV1Api, "patch_namespaced_stateful_set",
+            new_callable=AsyncMock,
+        )
+        body = {}
+
+        async def patch_stateful_set():
+            await self.harness.charm._patch_stateful_set()
+            # Serialize the body as the API client would send it
+            client = resources.get_api_client()
+            body.update(client.sanitize_for_serialization(apply.call_args.kwargs["body"]))
+
+        charm._run_hook(patch_stateful_set())
+
+        apply.assert_awaited_once()
+        kwargs = apply.call_args.kwargs
+        self.assertEqual(kwargs["name"], "spgwu")
+        self.assertEqual(kwargs["namespace"], "ns")
+        self.assertEqual(kwargs["field_manager"], "spgwu-charm")
+        self.assertIs(kwargs["force"], True)
+        self.assertEqual(kwargs["_content_type"], "application/apply-patch+yaml")
+        self.assertEqual(body["apiVersion"], "apps/v1")
+        self.assertEqual(body["kind"], "StatefulSet")
+        self.assertEqual(body["metadata"], {"name": "spgwu", "namespace": "ns"})
+        template = body["spec"]["template"]
+        spec = template["spec"]
+        # Containers are merged into Juju's by name, so each must be addressed by name
+        containers = {c["name"]: c for c in spec["containers"]}
+        self.assertEqual(set(containers), {"spgwu", "charm"})
+        self.assertEqual(
+            containers["charm"]["env"],
+            [{"name": "POD_IP", "valueFrom": {"fieldRef": {"fieldPath": "status.podIP"}}}],
+        )
+        self.assertEqual(spec["initContainers"][0]["name"], "spgwu-iptables-init")
+        spgwu = containers["spgwu"]
+        self.assertEqual([e["name"] for e in spgwu["env"]], ["MEM_LIMIT"])
+        self.assertEqual(spgwu["resources"]["limits"], {"cpu": "4", "memory": "8Gi"})
+        self.assertEqual(
+            spgwu["securityContext"]["capabilities"]["add"], ["IPC_LOCK", "NET_ADMIN"]
+        )
+        self.assertTrue(spgwu["stdin"] and spgwu["tty"])
+        # Every volume mounted by the init containers is part of the patch
+        mounts = {m["name"] for c in spec["initContainers"] for m in c["volumeMounts"]}
+        self.assertLessEqual(mounts, {v["name"] for v in spec["volumes"]})
+        self.assertEqual(
+            spec["volumes"],
+            [{"configMap": {"defaultMode": 0o755, "name": "spgwu"}, "name": "dp-script"}],
+        )
+        networks = json.loads(template["metadata"]["annotations"]["k8s.v1.cni.cncf.io/networks"])
+        self.assertEqual([n["name"] for n in networks], ["s1u-net", "sgi-net"])
+
+    def revoke_cached_trust(self):
+        """Cache a recent successful probe, but have every API call now be refused"""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.auth_file = Path(tmp.name, "charm-authed")
+        self.auth_file.write_text(str(time.time()))
+        forbidden = kubernetes.client.exceptions.ApiException(status=403)
+        self.patch(charm, "AUTH_FILE", self.auth_file)
+        self.patch(charm, "PID1_ENVIRON", Path(tmp.name, "environ"))
+        charm.PID1_ENVIRON.write_bytes(b"")
+        self.patch(charm.kubernetes.config, "load_incluster_config")
+        self.patch(SpgwuCharm, "namespace", "ns")
+        self.patch(
+            charm.kubernetes.client.RbacAuthorizationV1Api, "list_cluster_role",
+            side_effect=forbidden,
+        )
+        return forbidden
+
+    def assert_blocked_and_deferred(self, event):
+        event.defer.assert_called_once_with()
+        self.assertIsInstance(self.harness.model.unit.status, BlockedStatus)
+        self.assertFalse(self.auth_file.exists())
+
+    def test_install_blocks_when_trust_is_revoked(self):
+        forbidden = self.revoke_cached_trust()
+        self.patch(charm.resources.SpgwuResources, "apply", side_effect=forbidden)
+        event = Mock()
+
+        charm._run_hook(self.harness.charm._install(event))
+
+        self.assert_blocked_and_deferred(event)
+
+    def test_config_changed_blocks_when_trust_is_revoked(self):
+        forbidden = self.revoke_cached_trust()
+        self.patch(
+            charm.kubernetes.client.AppsV1Api, "patch_namespaced_stateful_set",
+            side_effect=forbidden,
+        )
+        event = Mock()
+
+        charm._run_hook(self.harness.charm._config_changed(event))
+
+        self.assert_blocked_and_deferred(event)
+
+
+class TestIterFiles(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        for name in ("run.sh", "dp.cfg", "log.json", "README", ".hidden.cfg"):
+            Path(self.dir, name).touch()
+        Path(self.dir, "nested.cfg").mkdir()
+
+    def names(self, pattern):
+        return sorted(Path(p).name for p in resources.iter_files(self.dir, pattern))
+
+    def test_skips_dotfiles_and_directories(self):
+        self.assertEqual(self.names("*.*"), ["dp.cfg", "log.json", "run.sh"])
+        self.assertEqual(self.names("*"), ["README", "dp.cfg", "log.json", "run.sh"])
+
+    def test_matches_pattern(self):
+        self.assertEqual(self.names("*.cfg"), ["dp.cfg"])
+        self.assertEqual(self.names("run.sh"), ["run.sh"])
+        self.assertEqual(self.names("*.CFG"), [])
+
+    def test_missing_directory(self):
+        self.assertEqual(resources.iter_files(str(Path(self.dir, "missing")), "*.*"), [])
+
+    def test_returns_paths_in_directory(self):
+        self.assertEqual(
+            resources.iter_files(self.dir, "run.sh"), [str(Path(self.dir, "run.sh"))]
+        )
+
+
+class TestGather(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.resources = resources.SpgwuResources(Mock(namespace="ns"))
+
+    async def test_raises_first_error_after_all_calls_finish(self):
+        finished = []
+
+        async def call(i, delay, error=None):
+            await asyncio.sleep(delay)
+            if error:
+                raise error
+            finished.append(i)
+
+        tasks = [
+            call(0, 0.01, ValueError("first")),
+            call(1, 0.02),
+            call(2, 0, ValueError("second")),
+        ]
+        with self.assertLogs(resources.logger, "ERROR") as logs:
+            with self.assertRaisesRegex(ValueError, "first"):
+                await self.resources._gather(tasks)
+        self.assertEqual(finished, [1])
+        self.assertEqual(len(logs.records), 2)
+
+    async def test_bounds_calls_in_flight(self):
+        in_flight = peak = calls = 0
+
+        async def call():
+            nonlocal in_flight, peak, calls
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0)
+            in_flight -= 1
+            calls += 1
+
+        await self.resources._gather(
+            [call() for _ in range(resources.MAX_CONCURRENT_REQUESTS * 3)]
+        )
+        self.assertEqual(peak, resources.MAX_CONCURRENT_REQUESTS)
+        self.assertEqual(calls, resources.MAX_CONCURRENT_REQUESTS * 3)
+
+
+class TestReadPid1Environ(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        environ = Path(tmp.name, "environ")
+        environ.write_bytes(
+            b"HOME=/root\x00"
+            b"KUBERNETES_SERVICE_HOST=10.152.183.1\x00"
+            b"KUBERNETES_SERVICE_PORT=443\x00"
+            b"JUJU_VERSION=2.9.0\x00"
+            b"KUBERNETES_SERVICE_EXTRA=a=b==\x00"
+        )
+        patcher = patch.object(charm, "PID1_ENVIRON", environ)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def test_selects_prefixed_variables(self):
+        self.assertEqual(
+            charm._read_pid1_environ(b"KUBERNETES_SERVICE"),
+            {
+                "KUBERNETES_SERVICE_HOST": "10.152.183.1",
+                "KUBERNETES_SERVICE_PORT": "443",
+                "KUBERNETES_SERVICE_EXTRA": "a=b==",
+            },
+        )
+
+    def test_several_prefixes(self):
+        self.assertEqual(
+            charm._read_pid1_environ(b"HOME", b"JUJU_"),
+            {"HOME": "/root", "JUJU_VERSION": "2.9.0"},
+        )
+
+    def test_no_match(self):
+        self.assertEqual(charm._read_pid1_environ(b"POD_IP"), {})
+
+
+class TestSetContainerResourceLimits(unittest.TestCase):
+    def setUp(self):
+        self.resources = resources.SpgwuResources(Mock(namespace="ns"))
+        self.containers = [kubernetes.client.V1Container(name=str(i)) for i in range(3)]
+
+    def test_skips_first_container(self):
+        self.resources.set_container_resource_limits(self.containers)
+        self.assertIsNone(self.containers[0].resources)
+        for container in self.containers[1:]:
+            self.assertEqual(container.resources.limits, {"cpu": "0.2", "memory": "200Mi"})
+            self.assertEqual(container.resources.requests, {"cpu": "0.2", "memory": "200Mi"})
+
+    def test_all_containers(self):
+        self.resources.set_container_resource_limits(self.containers, skip_first=False)
+        self.assertIsNotNone(self.containers[0].resources)
+        self.assertEqual(len({id(c.resources) for c in self.containers}), 1)
+
+    def test_no_containers(self):
+        self.resources.set_container_resource_limits([])
+
+
+class TestApplyResources(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.resources = resources.SpgwuResources(Mock(namespace="ns"))
+        self.core_api = Mock()
+        patcher = patch.object(resources.SpgwuResources, "core_api", self.core_api)
+        self.addCleanup(patcher.stop)
+        patcher.start()
+
+    def resource(self, model):
+        metadata = kubernetes.client.V1ObjectMeta(name="x")
+        return {"namespace": "ns", "body": model(metadata=metadata)}
+
+    def api_calls(self, kind, create_error=None):
+        create = AsyncMock(side_effect=create_error)
+        patch_ = AsyncMock()
+        setattr(self.core_api, f"create_namespaced_{kind}", create)
+        setattr(self.core_api, f"patch_namespaced_{kind}", patch_)
+        return create, patch_
+
+    async def assert_created(self, apply, kind, model):
+        create, patch_ = self.api_calls(kind)
+        resource = self.resource(model)
+        await apply(resource)
+        create.assert_awaited_once_with(**resource)
+        patch_.assert_not_called()
+
+    async def assert_patched_on_conflict(self, apply, kind, model):
+        conflict = kubernetes.client.exceptions.ApiException(status=409)
+        create, patch_ = self.api_calls(kind, create_error=conflict)
+        resource = self.resource(model)
+        await apply(resource)
+        create.assert_awaited_once_with(**resource)
+        patch_.assert_awaited_once_with(name="x", **resource)
+
+    async def assert_other_errors_raised(self, apply, kind, model):
+        error = kubernetes.client.exceptions.ApiException(status=422)
+        create, patch_ = self.api_calls(kind, create_error=error)
+        with self.assertRaises(kubernetes.client.exceptions.ApiException) as cm:
+            await apply(self.resource(model))
+        self.assertIs(cm.exception, error)
+        patch_.assert_not_called()
+
+    async def test_service_created(self):
+        await self.assert_created(
+            self.resources._apply_service, "service", kubernetes.client.V1Service
+        )
+
+    async def test_existing_service_patched(self):
+        await self.assert_patched_on_conflict(
+            self.resources._apply_service, "service", kubernetes.client.V1Service
+        )
+
+    async def test_service_error_raised(self):
+        await self.assert_other_errors_raised(
+            self.resources._apply_service, "service", kubernetes.client.V1Service
+        )
+
+    async def test_configmap_created(self):
+        await self.assert_created(
+            self.resources._apply_configmap, "config_map", kubernetes.client.V1ConfigMap
+        )
+
+    async def test_existing_configmap_patched(self):
+        await self.assert_patched_on_conflict(
+            self.resources._apply_configmap, "config_map", kubernetes.client.V1ConfigMap
+        )
+
+    async def test_configmap_error_raised(self):
+        await self.assert_other_errors_raised(
+            self.resources._apply_configmap, "config_map", kubernetes.client.V1ConfigMap
+        )